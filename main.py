@@ -1,15 +1,43 @@
 """FastAPI inference server entry point."""
 import os
+import asyncio
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from dotenv import load_dotenv
+
+# Load environment variables before importing modules that read them at import time
+load_dotenv()
+
 from routers import generate
+from services.auth_cache import auth_cache
+from services.logger import logger
+from utils.http_client import HTTPClient
 from utils.throttle import ThrottleMiddleware
 
 
-# Load environment variables
-load_dotenv()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Open shared resources on startup and release them on shutdown."""
+    # Restart the log writer in case an earlier lifespan in this process stopped it
+    logger.start()
+    try:
+        # Created here rather than at import so the session binds to the serving event loop
+        async with HTTPClient() as http_client:
+            app.state.http_client = http_client
+            app.state.pending_webhooks = set()
+            try:
+                yield
+            finally:
+                # Let background webhooks finish before the session closes
+                if app.state.pending_webhooks:
+                    await asyncio.gather(*app.state.pending_webhooks, return_exceptions=True)
+    finally:
+        # Only after the client has flushed batched webhooks, so their failures still reach the log
+        await auth_cache.close()
+        logger.close()
+
 
 # Initialize FastAPI app
 app = FastAPI(
@@ -17,7 +45,8 @@ app = FastAPI(
     description="AI-based virtual try-on image generation service with modular AI providers (OpenAI, Gemini, Sora, Stability)",
     version="1.0.0",
     docs_url="/docs",
-    redoc_url="/redoc"
+    redoc_url="/redoc",
+    lifespan=lifespan
 )
 
 # CORS configuration
@@ -31,14 +60,21 @@ app.add_middleware(
 
 # Throttling middleware
 requests_per_minute = int(os.getenv("THROTTLE_RPM", "10"))
-app.add_middleware(ThrottleMiddleware, requests_per_minute=requests_per_minute)
+app.add_middleware(
+    ThrottleMiddleware,
+    requests_per_minute=requests_per_minute,
+    strategy=os.getenv("THROTTLE_STRATEGY", "token_bucket"),
+    max_users=int(os.getenv("THROTTLE_MAX_USERS", "100000"))
+)
 
 # Include routers
 app.include_router(generate.router)
 
-# Mount media directory for serving generated images
+# Mount media directory for serving generated images. In production set
+# SERVE_MEDIA=false and let the reverse proxy serve /media straight from disk.
 os.makedirs("media", exist_ok=True)
-app.mount("/media", StaticFiles(directory="media"), name="media")
+if os.getenv("SERVE_MEDIA", "true").lower() == "true":
+    app.mount("/media", StaticFiles(directory="media", check_dir=False), name="media")
 
 
 @app.get("/")
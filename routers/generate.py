@@ -1,17 +1,32 @@
 """Image generation router."""
 import os
 import time
+import secrets
+import base64
+import asyncio
 import aiohttp
-from fastapi import APIRouter, HTTPException, status, File, UploadFile, Form
-from pydantic import BaseModel, HttpUrl
+import aiofiles
+import aiofiles.os
+from pathlib import Path
+from fastapi import APIRouter, HTTPException, Request, status, File, UploadFile, Form
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, ConfigDict, HttpUrl
 from typing import Optional, Union
 from services.ai_provider import get_ai_provider
+from services.auth_cache import auth_cache
+from services.result_cache import result_cache
 from services.logger import logger
-from utils.http_client import http_client
+from utils.http_client import HTTPClient, read_response_bytes
 
 
 router = APIRouter(prefix="/api/v1", tags=["inference"])
 
+# Created at startup by main.py
+MEDIA_DIR = Path("media")
+
+# Bound concurrent provider calls; requests beyond this are rejected with 503
+generation_slots = asyncio.Semaphore(int(os.getenv("MAX_CONCURRENT_GENERATIONS", "32")))
+
 
 class GenerateRequest(BaseModel):
     """Request model for image generation (JSON with URLs)."""
@@ -24,39 +39,41 @@ class GenerateRequest(BaseModel):
 
 class GenerateResponse(BaseModel):
     """Response model for image generation."""
+    model_config = ConfigDict(frozen=True)
+    
     status: str
     image_url: Optional[str] = None
     latency_ms: float
 
 
-async def download_image(url: str) -> bytes:
+async def download_image(http_client: HTTPClient, url: str) -> bytes:
     """Download image from URL."""
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url) as response:
-            if response.status == 200:
-                return await response.read()
-            else:
-                raise Exception(f"Failed to download image from {url}: {response.status}")
+    session = await http_client.get_session()
+    async with session.get(url) as response:
+        if response.status == 200:
+            return await read_response_bytes(response)
+        else:
+            raise Exception(f"Failed to download image from {url}: {response.status}")
 
 
 async def read_file_to_bytes(file_path: str) -> bytes:
     """Read local file to bytes."""
     if not os.path.exists(file_path):
         raise Exception(f"File not found: {file_path}")
-    with open(file_path, "rb") as f:
-        return f.read()
+    async with aiofiles.open(file_path, "rb") as f:
+        return await f.read()
 
 
-async def get_image_data(source: Union[str, UploadFile, bytes]) -> bytes:
+async def get_image_data(http_client: HTTPClient, source: Union[str, UploadFile, bytes]) -> bytes:
     """Get image data from URL, file path, UploadFile, or bytes."""
-    if isinstance(source, bytes):
+    if isinstance(source, (bytes, bytearray)):
         return source
     elif isinstance(source, UploadFile):
         return await source.read()
     elif isinstance(source, str):
         # Check if it's a URL or file path
         if source.startswith(("http://", "https://")):
-            return await download_image(source)
+            return await download_image(http_client, source)
         else:
             # Local file path
             return await read_file_to_bytes(source)
@@ -64,30 +81,104 @@ async def get_image_data(source: Union[str, UploadFile, bytes]) -> bytes:
         raise Exception(f"Unsupported image source type: {type(source)}")
 
 
-async def save_image(image_url_or_data: str, filename: str) -> str:
+async def get_image_data_with_context(
+    http_client: HTTPClient,
+    source: Union[str, UploadFile, bytes],
+    role: str,
+    label: str
+) -> bytes:
+    """Get image data, re-raising failures with the image role and source attached."""
+    try:
+        return await get_image_data(http_client, source)
+    except Exception as e:
+        raise Exception(f"Failed to load {role} image from {label}: {str(e)}")
+
+
+async def verify_auth_cached(http_client: HTTPClient, user_id: str, api_key: str) -> dict:
+    """Verify authentication, serving repeat lookups from the auth cache."""
+    cached = await auth_cache.get_auth(user_id, api_key)
+    if cached is not None:
+        return cached
+    auth_result = await http_client.verify_auth(user_id, api_key)
+    await auth_cache.set_auth(user_id, api_key, auth_result)
+    return auth_result
+
+
+async def check_credits_cached(http_client: HTTPClient, user_id: str) -> dict:
+    """Check credits, serving repeat lookups from the auth cache."""
+    cached = await auth_cache.get_credits(user_id)
+    if cached is not None:
+        return cached
+    credits_result = await http_client.check_credits(user_id)
+    await auth_cache.set_credits(user_id, credits_result)
+    return credits_result
+
+
+async def download_image_to_file(http_client: HTTPClient, url: str, filepath: Path):
+    """Stream image from URL straight to a file without buffering it in memory."""
+    session = await http_client.get_session()
+    async with session.get(url) as response:
+        if response.status != 200:
+            raise Exception(f"Failed to download image from {url}: {response.status}")
+        async with aiofiles.open(filepath, "wb") as f:
+            async for chunk in response.content.iter_chunked(65536):
+                await f.write(chunk)
+
+
+async def send_webhook_safely(
+    http_client: HTTPClient,
+    user_id: str,
+    catalog_id: str,
+    image_url: str,
+    latency_ms: float,
+    ai_provider_name: str
+):
+    """Send usage webhook, logging failures instead of raising."""
+    try:
+        await http_client.send_webhook(
+            user_id=user_id,
+            used_credits=1,
+            catalog_id=catalog_id,
+            image_url=image_url,
+            latency_ms=latency_ms
+        )
+    except Exception as e:
+        # Log webhook failure but don't fail the request
+        logger.log_request(user_id, catalog_id, "warning", latency_ms, ai_provider_name, f"Webhook failed: {str(e)}")
+
+
+async def save_image(http_client: HTTPClient, image_url_or_data: str, filename: str) -> Path:
     """Download and save image to media directory. Handles URLs and base64 data URLs."""
-    import base64
-    os.makedirs("media", exist_ok=True)
-    filepath = os.path.join("media", filename)
-    
-    # Handle base64 data URL (from Gemini/Imagen)
-    if image_url_or_data.startswith("data:image"):
-        header, encoded = image_url_or_data.split(",", 1)
-        image_data = base64.b64decode(encoded)
-        with open(filepath, "wb") as f:
-            f.write(image_data)
-        return filepath
+    filepath = MEDIA_DIR / filename
+    # Write under a temporary name and rename on success, so a failed write never
+    # leaves a truncated image in the publicly served media directory
+    tmp_path = filepath.with_name(f"{filename}.part")
     
-    # Handle regular URL
-    image_data = await download_image(image_url_or_data)
-    with open(filepath, "wb") as f:
-        f.write(image_data)
+    try:
+        # Handle base64 data URL (from Gemini/Imagen)
+        if image_url_or_data.startswith("data:image"):
+            header, encoded = image_url_or_data.split(",", 1)
+            # Decoding a multi-MB payload is CPU-bound; keep it off the event loop
+            image_data = await asyncio.to_thread(base64.b64decode, encoded)
+            async with aiofiles.open(tmp_path, "wb") as f:
+                await f.write(image_data)
+        else:
+            # Handle regular URL
+            await download_image_to_file(http_client, image_url_or_data, tmp_path)
+        await aiofiles.os.replace(tmp_path, filepath)
+    except BaseException:
+        try:
+            await aiofiles.os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
     
     return filepath
 
 
-@router.post("/create-image", response_model=GenerateResponse)
+@router.post("/create-image", response_model=GenerateResponse, response_class=ORJSONResponse)
 async def create_image(
+    request: Request,
     user_id: str = Form(...),
     api_key: str = Form(...),
     catalog_id: str = Form(...),
@@ -99,15 +190,14 @@ async def create_image(
     """Generate virtual try-on image. Accepts file uploads or URLs."""
     start_time = time.time()
     ai_provider_name = os.getenv("AI_PROVIDER", "openai")
+    http_client: HTTPClient = request.app.state.http_client
     
     try:
-        # Get image data from files or URLs
+        # Resolve image sources from files or URLs
         if user_image:
-            user_img_data = await get_image_data(user_image)
-            user_img_source = "uploaded_file"
+            user_src, user_img_source = user_image, "uploaded_file"
         elif user_image_url:
-            user_img_data = await get_image_data(user_image_url)
-            user_img_source = user_image_url
+            user_src, user_img_source = user_image_url, user_image_url
         else:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
@@ -115,27 +205,54 @@ async def create_image(
             )
         
         if catalog_image:
-            catalog_img_data = await get_image_data(catalog_image)
-            catalog_img_source = "uploaded_file"
+            catalog_src, catalog_img_source = catalog_image, "uploaded_file"
         elif catalog_image_url:
-            catalog_img_data = await get_image_data(catalog_image_url)
-            catalog_img_source = catalog_image_url
+            catalog_src, catalog_img_source = catalog_image_url, catalog_image_url
         else:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="Either catalog_image file or catalog_image_url must be provided"
             )
         
+        # Identical URL-based requests can reuse a recently generated image
+        result_key = None
+        cached_image_url = None
+        if not user_image and not catalog_image:
+            result_key = result_cache.make_key(user_id, catalog_id, user_image_url, catalog_image_url)
+            cached_image_url = result_cache.get(result_key)
+        
+        # Start auth and credit checks so backend round trips overlap the image fetches
+        auth_task = asyncio.create_task(verify_auth_cached(http_client, user_id, api_key))
+        credits_task = asyncio.create_task(check_credits_cached(http_client, user_id))
+        
+        if cached_image_url is None:
+            # Fetch both images concurrently
+            user_img_data, catalog_img_data = await asyncio.gather(
+                get_image_data_with_context(http_client, user_src, "user", user_img_source),
+                get_image_data_with_context(http_client, catalog_src, "catalog", catalog_img_source),
+                return_exceptions=True
+            )
+            for img_result in (user_img_data, catalog_img_data):
+                if isinstance(img_result, BaseException):
+                    auth_task.cancel()
+                    credits_task.cancel()
+                    latency_ms = (time.time() - start_time) * 1000
+                    logger.log_request(user_id, catalog_id, "error", latency_ms, ai_provider_name, str(img_result))
+                    raise HTTPException(
+                        status_code=status.HTTP_400_BAD_REQUEST,
+                        detail=str(img_result)
+                    )
+        
+        auth_result, credits_result = await asyncio.gather(auth_task, credits_task, return_exceptions=True)
+        
         # Step 1: Verify authentication
-        try:
-            auth_result = await http_client.verify_auth(user_id, api_key)
-        except Exception as e:
+        if isinstance(auth_result, BaseException):
             latency_ms = (time.time() - start_time) * 1000
-            error_msg = f"Backend connection error during auth: {str(e)}"
+            error_msg = f"Backend connection error during auth: {str(auth_result)}"
             logger.log_request(user_id, catalog_id, "error", latency_ms, ai_provider_name, error_msg)
             raise HTTPException(
                 status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
-                detail=f"Unable to verify authentication. Backend may be unavailable: {str(e)}"
+                detail=f"Unable to verify authentication. Backend may be unavailable: {str(auth_result)}"
             )
         
         if auth_result.get("status") == 401 or auth_result.get("error") == "Unauthorized":
@@ -148,15 +265,13 @@ async def create_image(
             )
         
         # Step 2: Check credits
-        try:
-            credits_result = await http_client.check_credits(user_id)
-        except Exception as e:
+        if isinstance(credits_result, BaseException):
             latency_ms = (time.time() - start_time) * 1000
-            error_msg = f"Backend connection error during credit check: {str(e)}"
+            error_msg = f"Backend connection error during credit check: {str(credits_result)}"
             logger.log_request(user_id, catalog_id, "error", latency_ms, ai_provider_name, error_msg)
             raise HTTPException(
                 status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
-                detail=f"Unable to check credits. Backend may be unavailable: {str(e)}"
+                detail=f"Unable to check credits. Backend may be unavailable: {str(credits_result)}"
             )
         
         if credits_result.get("status") == 403 or credits_result.get("error") == "Forbidden":
@@ -178,92 +293,87 @@ async def create_image(
                 detail=f"Insufficient credits: {error_detail}. Available credits: {available_credits}"
             )
         
-        # Step 3: Save uploaded images temporarily and generate
-        try:
-            # Save images to temp files for provider
-            import tempfile
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".jpeg") as tmp_user:
-                tmp_user.write(user_img_data)
-                tmp_user_path = tmp_user.name
-            
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".jpeg") as tmp_catalog:
-                tmp_catalog.write(catalog_img_data)
-                tmp_catalog_path = tmp_catalog.name
+        if cached_image_url is not None:
+            image_url = cached_image_url
+        else:
+            # Step 3: Generate from the in-memory image bytes
+            if generation_slots.locked():
+                latency_ms = (time.time() - start_time) * 1000
+                logger.log_request(user_id, catalog_id, "error", latency_ms, ai_provider_name, "Server busy: generation capacity exhausted")
+                raise HTTPException(
+                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    detail="Server is busy generating other images. Please retry shortly."
+                )
             
             try:
-                ai_provider = get_ai_provider()
-                generated_image_url = await ai_provider.generate_image(
-                    tmp_user_path,
-                    tmp_catalog_path
+                ai_provider = get_ai_provider(http_client)
+                async with generation_slots:
+                    generated_image_url = await ai_provider.generate_image(
+                        user_img_data,
+                        catalog_img_data
+                    )
+            except ValueError as e:
+                latency_ms = (time.time() - start_time) * 1000
+                error_msg = f"Configuration error: {str(e)}"
+                logger.log_request(user_id, catalog_id, "error", latency_ms, ai_provider_name, error_msg)
+                raise HTTPException(
+                    status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                    detail=f"AI provider configuration error: {str(e)}. Please check environment variables."
+                )
+            except Exception as e:
+                latency_ms = (time.time() - start_time) * 1000
+                error_msg = f"Image generation failed: {str(e)}"
+                logger.log_request(user_id, catalog_id, "error", latency_ms, ai_provider_name, error_msg)
+                raise HTTPException(
+                    status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                    detail=f"Image generation failed: {str(e)}"
                 )
-            finally:
-                # Clean up temp files
-                try:
-                    os.unlink(tmp_user_path)
-                    os.unlink(tmp_catalog_path)
-                except:
-                    pass
-        except ValueError as e:
-            latency_ms = (time.time() - start_time) * 1000
-            error_msg = f"Configuration error: {str(e)}"
-            logger.log_request(user_id, catalog_id, "error", latency_ms, ai_provider_name, error_msg)
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail=f"AI provider configuration error: {str(e)}. Please check environment variables."
-            )
-        except Exception as e:
-            latency_ms = (time.time() - start_time) * 1000
-            error_msg = f"Image generation failed: {str(e)}"
-            logger.log_request(user_id, catalog_id, "error", latency_ms, ai_provider_name, error_msg)
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail=f"Image generation failed: {str(e)}"
-            )
         
-        # Step 4: Save image locally
-        try:
-            filename = f"{user_id}_{catalog_id}_{int(time.time())}.png"
-            local_image_path = await save_image(generated_image_url, filename)
-            image_url = f"/media/{filename}"
-        except aiohttp.ClientError as e:
-            latency_ms = (time.time() - start_time) * 1000
-            error_msg = f"Network error downloading image: {str(e)}"
-            logger.log_request(user_id, catalog_id, "error", latency_ms, ai_provider_name, error_msg)
-            raise HTTPException(
-                status_code=status.HTTP_502_BAD_GATEWAY,
-                detail=f"Failed to download generated image: {str(e)}"
-            )
-        except Exception as e:
-            latency_ms = (time.time() - start_time) * 1000
-            error_msg = f"Image save failed: {str(e)}"
-            logger.log_request(user_id, catalog_id, "error", latency_ms, ai_provider_name, error_msg)
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail=f"Failed to save image: {str(e)}"
-            )
+            # Step 4: Save image locally
+            try:
+                filename = f"{user_id}_{catalog_id}_{time.time_ns()}_{secrets.token_hex(3)}.png"
+                local_image_path = await save_image(http_client, generated_image_url, filename)
+                image_url = f"/media/{filename}"
+            except aiohttp.ClientError as e:
+                latency_ms = (time.time() - start_time) * 1000
+                error_msg = f"Network error downloading image: {str(e)}"
+                logger.log_request(user_id, catalog_id, "error", latency_ms, ai_provider_name, error_msg)
+                raise HTTPException(
+                    status_code=status.HTTP_502_BAD_GATEWAY,
+                    detail=f"Failed to download generated image: {str(e)}"
+                )
+            except Exception as e:
+                latency_ms = (time.time() - start_time) * 1000
+                error_msg = f"Image save failed: {str(e)}"
+                logger.log_request(user_id, catalog_id, "error", latency_ms, ai_provider_name, error_msg)
+                raise HTTPException(
+                    status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                    detail=f"Failed to save image: {str(e)}"
+                )
+            
+            if result_key is not None:
+                result_cache.set(result_key, image_url)
         
-        # Step 5: Send webhook to backend
+        # Step 5: Send webhook to backend in the background
         latency_ms = (time.time() - start_time) * 1000
-        try:
-            await http_client.send_webhook(
-                user_id=user_id,
-                used_credits=1,
-                catalog_id=catalog_id,
-                image_url=image_url,
-                latency_ms=latency_ms
-            )
-        except Exception as e:
-            # Log webhook failure but don't fail the request
-            logger.log_request(user_id, catalog_id, "warning", latency_ms, ai_provider_name, f"Webhook failed: {str(e)}")
+        webhook_task = asyncio.create_task(
+            send_webhook_safely(http_client, user_id, catalog_id, image_url, latency_ms, ai_provider_name)
+        )
+        pending_webhooks = request.app.state.pending_webhooks
+        pending_webhooks.add(webhook_task)
+        webhook_task.add_done_callback(pending_webhooks.discard)
+        await auth_cache.invalidate_credits(user_id)
         
         # Step 6: Log success and return response
         logger.log_request(user_id, catalog_id, "success", latency_ms, ai_provider_name)
         
-        return GenerateResponse(
-            status="success",
-            image_url=image_url,
-            latency_ms=latency_ms
-        )
+        # Return the payload directly so FastAPI skips re-validating it against
+        # GenerateResponse; orjson handles serialization
+        return ORJSONResponse({
+            "status": "success",
+            "image_url": image_url,
+            "latency_ms": latency_ms
+        })
     
     except HTTPException:
         raise
@@ -1,45 +1,94 @@
 """Modular AI provider interface for image generation."""
+import io
 import os
+import time
 import asyncio
 import aiohttp
+import PIL.Image
 from abc import ABC, abstractmethod
-from typing import Optional
-from openai import OpenAI, OpenAIError
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timezone
+from typing import Dict, Optional, Union
+from openai import AsyncOpenAI, OpenAIError
 import google.generativeai as genai
 from google.generativeai.types import HarmCategory, HarmBlockThreshold
 from google.api_core import exceptions as google_exceptions
+from utils.http_client import HTTPClient, read_response_bytes
+
+
+# CPU-bound image decoding/resizing runs on its own small pool so it never waits behind
+# (or starves) blocking API calls on the default executor.
+image_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("IMAGE_DECODE_WORKERS", os.cpu_count() or 4)),
+    thread_name_prefix="image-decode"
+)
+
+
+# Long edge that source images are downscaled to before being sent to Gemini
+max_image_edge = int(os.getenv("IMAGE_MAX_EDGE", "1024"))
+
+
+def prepare_image(data: bytes, max_edge: int = max_image_edge) -> PIL.Image.Image:
+    """Decode image bytes, downscaling oversized images and re-encoding them as JPEG."""
+    img = PIL.Image.open(io.BytesIO(data))
+    if max(img.size) <= max_edge:
+        img.load()
+        return img
+    
+    # Let the JPEG decoder skip straight to a reduced scale where possible
+    img.draft("RGB", (max_edge, max_edge))
+    if img.has_transparency_data:
+        # JPEG has no alpha: flatten transparent areas (e.g. cut-out garment shots)
+        # onto white instead of letting convert("RGB") turn them black
+        img = img.convert("RGBA")
+        img.thumbnail((max_edge, max_edge), PIL.Image.LANCZOS)
+        flattened = PIL.Image.new("RGB", img.size, (255, 255, 255))
+        flattened.paste(img, mask=img.getchannel("A"))
+        img = flattened
+    else:
+        img.thumbnail((max_edge, max_edge), PIL.Image.LANCZOS)
+    buf = io.BytesIO()
+    img.convert("RGB").save(buf, "JPEG", quality=85, optimize=True)
+    buf.seek(0)
+    resized = PIL.Image.open(buf)
+    resized.load()
+    return resized
 
 
 class AIProvider(ABC):
     """Abstract base class for AI providers."""
     
+    def __init__(self, http_client: HTTPClient):
+        self.http_client = http_client
+    
     @abstractmethod
     async def generate_image(
         self,
-        user_img_url: str,
-        catalog_img_url: str,
+        user_img: Union[bytes, str],
+        catalog_img: Union[bytes, str],
         prompt: Optional[str] = None
     ) -> str:
-        """Generate virtual try-on image."""
+        """Generate virtual try-on image from raw image bytes or image URLs."""
         pass
 
 
 class OpenAIProvider(AIProvider):
     """OpenAI DALL-E provider for image generation."""
     
-    def __init__(self):
+    def __init__(self, http_client: HTTPClient):
+        super().__init__(http_client)
         api_key = os.getenv("OPENAI_API_KEY")
         if not api_key:
             raise ValueError("OPENAI_API_KEY not found in environment variables")
-        self.client = OpenAI(api_key=api_key)
+        self.client = AsyncOpenAI(api_key=api_key)
         self.model = "dall-e-3"
         self.size = "1024x1024"
         self.quality = "hd"
     
     async def generate_image(
         self,
-        user_img_url: str,
-        catalog_img_url: str,
+        user_img: Union[bytes, str],
+        catalog_img: Union[bytes, str],
         prompt: Optional[str] = None
     ) -> str:
         """Generate virtual try-on image using OpenAI DALL-E."""
@@ -55,16 +104,12 @@ class OpenAIProvider(AIProvider):
             )
         
         try:
-            loop = asyncio.get_event_loop()
-            response = await loop.run_in_executor(
-                None,
-                lambda: self.client.images.generate(
-                    model=self.model,
-                    prompt=prompt,
-                    size=self.size,
-                    quality=self.quality,
-                    n=1
-                )
+            response = await self.client.images.generate(
+                model=self.model,
+                prompt=prompt,
+                size=self.size,
+                quality=self.quality,
+                n=1
             )
             
             if response.data and len(response.data) > 0:
@@ -81,18 +126,42 @@ class OpenAIProvider(AIProvider):
 class GeminiProvider(AIProvider):
     """Google Gemini provider for image generation using Imagen API."""
     
-    def __init__(self):
+    def __init__(self, http_client: HTTPClient):
+        super().__init__(http_client)
         api_key = os.getenv("GOOGLE_API_KEY")
         if not api_key:
             raise ValueError("GOOGLE_API_KEY not found in environment variables")
         genai.configure(api_key=api_key)
         self.api_key = api_key
+        self._credentials = None
+        self._token: Optional[str] = None
+        self._token_expiry = 0.0
+        self._token_lock = asyncio.Lock()
         self.model = "gemini-2.5-flash-image"
         self.prompt_template = (
             "take the person from the first reference image and the garment and the setting "
             "from the second image, virtual try on should match the model's body. catalogue shoot. "
             "4k. photorealistic. new shot and visual. three quarter angle shot"
         )
+        self.analysis_suffix = (
+            "\n\n"
+            "First image shows the person/model. Second image shows the garment and setting. "
+            "Create a detailed prompt for generating the virtual try-on result."
+        )
+        self.analysis_prompt = self.prompt_template + self.analysis_suffix
+        self.safety_settings = {
+            HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
+            HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
+            HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
+            HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
+        }
+        try:
+            self._model = genai.GenerativeModel(
+                model_name=self.model,
+                safety_settings=self.safety_settings
+            )
+        except Exception as e:
+            raise ValueError(f"Failed to initialize Gemini model '{self.model}': {str(e)}. Check if model name is correct.")
     
     async def _download_image(self, url_or_path: str) -> bytes:
         """Download image from URL or read from local file path."""
@@ -106,17 +175,17 @@ class GeminiProvider(AIProvider):
         
         # Otherwise, treat as URL
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url_or_path, timeout=aiohttp.ClientTimeout(total=30)) as response:
-                    if response.status == 200:
-                        return await response.read()
-                    elif response.status == 404:
-                        raise Exception(f"Image not found at URL: {url_or_path}")
-                    elif response.status == 403:
-                        raise Exception(f"Access forbidden for image URL: {url_or_path}")
-                    else:
-                        error_text = await response.text()
-                        raise Exception(f"Failed to download image from {url_or_path}: HTTP {response.status} - {error_text[:100]}")
+            session = await self.http_client.get_session()
+            async with session.get(url_or_path, timeout=aiohttp.ClientTimeout(total=30)) as response:
+                if response.status == 200:
+                    return await read_response_bytes(response)
+                elif response.status == 404:
+                    raise Exception(f"Image not found at URL: {url_or_path}")
+                elif response.status == 403:
+                    raise Exception(f"Access forbidden for image URL: {url_or_path}")
+                else:
+                    error_text = await response.text()
+                    raise Exception(f"Failed to download image from {url_or_path}: HTTP {response.status} - {error_text[:100]}")
         except aiohttp.ClientError as e:
             raise Exception(f"Network error downloading image from {url_or_path}: {str(e)}")
         except asyncio.TimeoutError:
@@ -124,64 +193,48 @@ class GeminiProvider(AIProvider):
         except Exception as e:
             raise Exception(f"Error downloading image from {url_or_path}: {str(e)}")
     
+    async def _load_image(self, source: Union[bytes, str], role: str) -> bytes:
+        """Return image bytes as-is, or download them, re-raising failures with the image role attached."""
+        if isinstance(source, (bytes, bytearray)):
+            return source
+        try:
+            return await self._download_image(source)
+        except Exception as e:
+            raise Exception(f"Failed to download {role} image from {source}: {str(e)}")
+    
     async def generate_image(
         self,
-        user_img_url: str,
-        catalog_img_url: str,
+        user_img: Union[bytes, str],
+        catalog_img: Union[bytes, str],
         prompt: Optional[str] = None
     ) -> str:
         """Generate virtual try-on image using Google Gemini/Imagen."""
         try:
-            # Download images with detailed error handling
-            try:
-                user_img_data = await self._download_image(user_img_url)
-            except Exception as e:
-                raise Exception(f"Failed to download user image from {user_img_url}: {str(e)}")
-            
-            try:
-                catalog_img_data = await self._download_image(catalog_img_url)
-            except Exception as e:
-                raise Exception(f"Failed to download catalog image from {catalog_img_url}: {str(e)}")
+            # Resolve both images concurrently (downloads only when given URLs)
+            user_img_data, catalog_img_data = await asyncio.gather(
+                self._load_image(user_img, "user"),
+                self._load_image(catalog_img, "catalog")
+            )
             
             final_prompt = prompt or self.prompt_template
             
-            loop = asyncio.get_event_loop()
-            
-            safety_settings = {
-                HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
-                HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
-                HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
-                HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
-            }
+            loop = asyncio.get_running_loop()
             
             try:
-                model = genai.GenerativeModel(
-                    model_name=self.model,
-                    safety_settings=safety_settings
+                user_pil_img, catalog_pil_img = await asyncio.gather(
+                    loop.run_in_executor(image_executor, prepare_image, user_img_data),
+                    loop.run_in_executor(image_executor, prepare_image, catalog_img_data)
                 )
-            except Exception as e:
-                raise Exception(f"Failed to initialize Gemini model '{self.model}': {str(e)}. Check if model name is correct.")
-            
-            import PIL.Image
-            import io
-            
-            try:
-                user_img = PIL.Image.open(io.BytesIO(user_img_data))
-                catalog_img = PIL.Image.open(io.BytesIO(catalog_img_data))
             except Exception as e:
                 raise Exception(f"Failed to process images: {str(e)}. Ensure URLs point to valid image files.")
             
             # Use Gemini to enhance prompt with image context
-            analysis_prompt = (
-                f"{final_prompt}\n\n"
-                "First image shows the person/model. Second image shows the garment and setting. "
-                "Create a detailed prompt for generating the virtual try-on result."
-            )
+            analysis_prompt = final_prompt + self.analysis_suffix if prompt else self.analysis_prompt
             
             try:
-                response = await loop.run_in_executor(
-                    None,
-                    lambda: model.generate_content([analysis_prompt, user_img, catalog_img])
+                response = await asyncio.to_thread(
+                    self._model.generate_content,
+                    [analysis_prompt, user_pil_img, catalog_pil_img]
                 )
             except google_exceptions.GoogleAPIError as e:
                 raise Exception(f"Gemini API error: {str(e)}. Check your API key and quota.")
@@ -232,16 +285,16 @@ class GeminiProvider(AIProvider):
                     }
                 }
                 
-                async with aiohttp.ClientSession() as session:
-                    async with session.post(url, json=payload, headers=headers, timeout=aiohttp.ClientTimeout(total=120)) as response:
-                        if response.status == 200:
-                            result = await response.json()
-                            if "predictions" in result and result["predictions"]:
-                                img_data = result["predictions"][0].get("bytesBase64Encoded", "")
-                                if img_data:
-                                    return f"data:image/png;base64,{img_data}"
-                        error_text = await response.text()
-                        raise Exception(f"Imagen API error: {response.status} - {error_text}")
+                session = await self.http_client.get_session()
+                async with session.post(url, json=payload, headers=headers, timeout=aiohttp.ClientTimeout(total=120)) as response:
+                    if response.status == 200:
+                        result = await response.json()
+                        if "predictions" in result and result["predictions"]:
+                            img_data = result["predictions"][0].get("bytesBase64Encoded", "")
+                            if img_data:
+                                return f"data:image/png;base64,{img_data}"
+                    error_text = await response.text()
+                    raise Exception(f"Imagen API error: {response.status} - {error_text}")
             except Exception as e:
                 # If Imagen fails, fall through to alternative method
                 pass
@@ -268,18 +321,33 @@ class GeminiProvider(AIProvider):
         )
     
     async def _get_access_token(self) -> str:
-        """Get access token for Vertex AI."""
-        # Try service account first
-        service_account_path = os.getenv("GOOGLE_APPLICATION_CREDENTIALS")
-        if service_account_path and os.path.exists(service_account_path):
-            try:
-                from google.auth import default
-                from google.auth.transport.requests import Request
-                credentials, _ = default()
-                credentials.refresh(Request())
-                return credentials.token
-            except Exception:
-                pass
+        """Get access token for Vertex AI, reusing it until shortly before expiry."""
+        if self._token and time.time() < self._token_expiry - 60:
+            return self._token
+        
+        async with self._token_lock:
+            # Another request may have refreshed the token while we waited
+            if self._token and time.time() < self._token_expiry - 60:
+                return self._token
+            
+            # Try service account first
+            service_account_path = os.getenv("GOOGLE_APPLICATION_CREDENTIALS")
+            if service_account_path and os.path.exists(service_account_path):
+                try:
+                    from google.auth import default
+                    from google.auth.transport.requests import Request
+                    if self._credentials is None:
+                        self._credentials, _ = await asyncio.to_thread(default)
+                    await asyncio.to_thread(self._credentials.refresh, Request())
+                    self._token = self._credentials.token
+                    expiry = self._credentials.expiry
+                    # google-auth reports expiry as a naive UTC datetime
+                    self._token_expiry = (
+                        expiry.replace(tzinfo=timezone.utc).timestamp() if expiry else time.time() + 300
+                    )
+                    return self._token
+                except Exception:
+                    pass
         
         # Fallback: Try to use API key (may work for some endpoints)
         return self.api_key
@@ -290,8 +358,8 @@ class SoraProvider(AIProvider):
     
     async def generate_image(
         self,
-        user_img_url: str,
-        catalog_img_url: str,
+        user_img: Union[bytes, str],
+        catalog_img: Union[bytes, str],
         prompt: Optional[str] = None
     ) -> str:
         """Placeholder for Sora implementation."""
@@ -303,27 +371,37 @@ class StabilityProvider(AIProvider):
     
     async def generate_image(
         self,
-        user_img_url: str,
-        catalog_img_url: str,
+        user_img: Union[bytes, str],
+        catalog_img: Union[bytes, str],
         prompt: Optional[str] = None
     ) -> str:
         """Placeholder for Stability AI implementation."""
         raise NotImplementedError("Stability AI provider not yet implemented")
 
 
-def get_ai_provider() -> AIProvider:
-    """Get AI provider based on environment configuration."""
+providers = {
+    "openai": OpenAIProvider,
+    "sora": SoraProvider,
+    "gemini": GeminiProvider,
+    "stability": StabilityProvider
+}
+
+# Providers hold API clients and connection pools, so build each once per process
+_provider_cache: Dict[str, AIProvider] = {}
+
+
+def get_ai_provider(http_client: HTTPClient) -> AIProvider:
+    """Get AI provider based on environment configuration, bound to the app's HTTP client."""
     provider_name = os.getenv("AI_PROVIDER", "openai").lower()
     
-    providers = {
-        "openai": OpenAIProvider,
-        "sora": SoraProvider,
-        "gemini": GeminiProvider,
-        "stability": StabilityProvider
-    }
+    provider = _provider_cache.get(provider_name)
+    # Rebuild if the app was restarted with a new client (e.g. a second lifespan in tests)
+    if provider is not None and provider.http_client is http_client:
+        return provider
     
     provider_class = providers.get(provider_name)
     if not provider_class:
         raise ValueError(f"Unknown AI provider: {provider_name}")
     
-    return provider_class()
+    provider = _provider_cache[provider_name] = provider_class(http_client)
+    return provider
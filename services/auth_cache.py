@@ -0,0 +1,122 @@
+"""Short-lived cache for backend auth and credit lookups."""
+import os
+import json
+import time
+import hashlib
+from collections import OrderedDict
+from typing import Dict, Any, Optional, Tuple
+
+
+class AuthCache:
+    """Two-level cache for auth/credit results: a per-process LRU in front of Redis.
+
+    The in-process level is always on; Redis is shared across workers and is
+    disabled when REDIS_URL is not set.
+    """
+
+    def __init__(self):
+        self.redis_url = os.getenv("REDIS_URL")
+        self.auth_ttl = float(os.getenv("AUTH_CACHE_TTL", "60"))
+        self.credits_ttl = float(os.getenv("CREDITS_CACHE_TTL", "5"))
+        self.max_entries = 10_000
+        # cache key -> (expires_at, result), least recently used first
+        self._local: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self.redis = None
+        if self.redis_url:
+            import redis.asyncio as aioredis
+            self.redis = aioredis.from_url(self.redis_url)
+
+    @staticmethod
+    def _auth_key(user_id: str, api_key: str) -> str:
+        api_key_hash = hashlib.sha256(api_key.encode()).hexdigest()
+        return f"auth:{user_id}:{api_key_hash}"
+
+    @staticmethod
+    def _credits_key(user_id: str) -> str:
+        return f"credits:{user_id}"
+
+    def _get_local(self, key: str) -> Optional[Dict[str, Any]]:
+        """Read an unexpired result from the in-process cache."""
+        entry = self._local.get(key)
+        if entry is None:
+            return None
+        expires_at, result = entry
+        if time.monotonic() >= expires_at:
+            del self._local[key]
+            return None
+        self._local.move_to_end(key)
+        return result
+
+    def _set_local(self, key: str, ttl: float, result: Dict[str, Any]):
+        """Store a result in the in-process cache, evicting the least recently used entries."""
+        self._local[key] = (time.monotonic() + ttl, result)
+        self._local.move_to_end(key)
+        while len(self._local) > self.max_entries:
+            self._local.popitem(last=False)
+
+    async def _get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Read a cached result, in process first; cache failures are treated as misses."""
+        result = self._get_local(key)
+        if result is not None or self.redis is None:
+            return result
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                cached, ttl_ms = await pipe.get(key).pttl(key).execute()
+        except Exception:
+            return None
+        if not cached:
+            return None
+        result = json.loads(cached)
+        # Keep the local copy only for what is left of the Redis TTL
+        if ttl_ms > 0:
+            self._set_local(key, ttl_ms / 1000, result)
+        return result
+
+    async def _set(self, key: str, ttl: float, result: Dict[str, Any]):
+        """Store a result in both levels; cache failures are ignored."""
+        if ttl <= 0:
+            return
+        self._set_local(key, ttl, result)
+        if self.redis is None:
+            return
+        try:
+            await self.redis.set(key, json.dumps(result), px=max(1, int(ttl * 1000)))
+        except Exception:
+            pass
+
+    async def get_auth(self, user_id: str, api_key: str) -> Optional[Dict[str, Any]]:
+        """Get cached auth result for user and API key."""
+        return await self._get(self._auth_key(user_id, api_key))
+
+    async def set_auth(self, user_id: str, api_key: str, result: Dict[str, Any]):
+        """Cache a successful auth result."""
+        if "error" not in result:
+            await self._set(self._auth_key(user_id, api_key), self.auth_ttl, result)
+
+    async def get_credits(self, user_id: str) -> Optional[Dict[str, Any]]:
+        """Get cached credit check result for user."""
+        return await self._get(self._credits_key(user_id))
+
+    async def set_credits(self, user_id: str, result: Dict[str, Any]):
+        """Cache a credit check result that allows generation."""
+        if "error" not in result and result.get("has_credits", False):
+            await self._set(self._credits_key(user_id), self.credits_ttl, result)
+
+    async def invalidate_credits(self, user_id: str):
+        """Drop cached credits for user after credits are consumed."""
+        key = self._credits_key(user_id)
+        self._local.pop(key, None)
+        if self.redis is None:
+            return
+        try:
+            await self.redis.delete(key)
+        except Exception:
+            pass
+
+    async def close(self):
+        """Close the Redis connection pool."""
+        if self.redis is not None:
+            await self.redis.aclose()
+
+
+auth_cache = AuthCache()
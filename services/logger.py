@@ -1,9 +1,11 @@
 """Structured logging for inference requests."""
 import os
+import time
+import queue
 import logging
-from logging.handlers import RotatingFileHandler
+import orjson
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 from typing import Dict, Any, Optional
-from datetime import datetime
 
 
 class InferenceLogger:
@@ -16,6 +18,9 @@ class InferenceLogger:
         self.logger = logging.getLogger("inference")
         self.logger.setLevel(getattr(logging, os.getenv("LOG_LEVEL", "INFO")))
         
+        self.listener: Optional[QueueListener] = None
+        self._log_queue: Optional[queue.Queue] = None
+        self._file_handler: Optional[logging.Handler] = None
         if not self.logger.handlers:
             handler = RotatingFileHandler(
                 f"{self.log_dir}/inference.log",
@@ -26,7 +31,18 @@ class InferenceLogger:
                 "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
             )
             handler.setFormatter(formatter)
-            self.logger.addHandler(handler)
+            
+            # Hand records to a background thread so file writes never block the event loop
+            self._log_queue = queue.Queue(-1)
+            self._file_handler = handler
+            self.logger.addHandler(QueueHandler(self._log_queue))
+            self.start()
+    
+    def start(self):
+        """Start the background writer if it isn't running (e.g. after close())."""
+        if self.listener is None and self._log_queue is not None:
+            self.listener = QueueListener(self._log_queue, self._file_handler)
+            self.listener.start()
     
     def log_request(
         self,
@@ -44,14 +60,25 @@ class InferenceLogger:
             "status": status,
             "latency_ms": latency_ms,
             "ai_provider": ai_provider,
-            "timestamp": datetime.utcnow().isoformat()
+            "timestamp": time.time()
         }
         
         if error:
             log_data["error"] = error
-            self.logger.error(f"Inference request: {log_data}")
+            self.logger.error("Inference request: %s", orjson.dumps(log_data).decode())
         else:
-            self.logger.info(f"Inference request: {log_data}")
+            self.logger.info("Inference request: %s", orjson.dumps(log_data).decode())
+    
+    def log_event(self, event: str, level: int = logging.INFO, **fields: Any):
+        """Log a non-request event as a structured record."""
+        log_data = {"event": event, **fields, "timestamp": time.time()}
+        self.logger.log(level, "Event: %s", orjson.dumps(log_data).decode())
+    
+    def close(self):
+        """Flush queued records and stop the background writer."""
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
 
 
 logger = InferenceLogger()
@@ -0,0 +1,45 @@
+"""In-process cache of recently generated images keyed by request inputs."""
+import os
+import time
+import hashlib
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+
+class ResultCache:
+    """TTL cache mapping identical URL-based generation requests to their saved image URL."""
+
+    def __init__(self):
+        self.ttl = int(os.getenv("RESULT_CACHE_TTL", "3600"))
+        self.max_entries = int(os.getenv("RESULT_CACHE_SIZE", "1024"))
+        self._entries: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+
+    @staticmethod
+    def make_key(user_id: str, catalog_id: str, user_image_url: str, catalog_image_url: str) -> str:
+        """Build cache key from the request inputs."""
+        raw = "\x00".join((user_id, catalog_id, user_image_url, catalog_image_url))
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        """Get cached image URL, or None if missing or expired."""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, image_url = entry
+        if time.monotonic() >= expires_at:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return image_url
+
+    def set(self, key: str, image_url: str):
+        """Cache image URL for key, evicting the least recently used entries."""
+        if self.ttl <= 0:
+            return
+        self._entries[key] = (time.monotonic() + self.ttl, image_url)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+
+result_cache = ResultCache()
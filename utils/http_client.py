@@ -1,9 +1,142 @@
 """Async HTTP client for Django backend integration."""
 import os
+import random
 import asyncio
 import aiohttp
-from typing import Dict, Optional, Any
+import orjson
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
 from aiohttp import ClientError, ClientTimeout
+from utils.webhook_batcher import WebhookBatcher
+
+
+AUTH_VERIFY_ENDPOINT = "/api/v1/auth/verify/"
+CREDITS_CHECK_ENDPOINT = "/api/v1/credits/check/"
+WEBHOOK_ENDPOINT = "/api/v1/inference/webhook/"
+WEBHOOK_BULK_ENDPOINT = "/api/v1/inference/webhook/bulk/"
+
+# Largest image body read into memory from a remote URL
+MAX_IMAGE_BYTES = int(os.getenv("MAX_IMAGE_BYTES", str(20 * 1024 * 1024)))
+
+# Static parts of the error payloads returned for backend error statuses;
+# copied and filled in per response
+_ERR_401 = {"error": "Unauthorized", "status": 401}
+_ERR_403 = {"error": "Forbidden", "status": 403}
+_ERR_404 = {"error": "Not Found", "status": 404}
+_ERR_5XX = {"error": "Backend Server Error"}
+
+
+def _build_401(response_data: Dict[str, Any], endpoint: str) -> Dict[str, Any]:
+    """Build error payload for 401 responses."""
+    error_msg = response_data.get("detail") or response_data.get("error") or "Authentication failed"
+    result = _ERR_401.copy()
+    result["detail"] = error_msg
+    result["message"] = f"Authentication failed: {error_msg}"
+    return result
+
+
+def _build_403(response_data: Dict[str, Any], endpoint: str) -> Dict[str, Any]:
+    """Build error payload for 403 responses."""
+    error_msg = response_data.get("detail") or response_data.get("error") or "Access forbidden"
+    result = _ERR_403.copy()
+    result["detail"] = error_msg
+    result["message"] = f"Insufficient credits or access denied: {error_msg}"
+    return result
+
+
+def _build_404(response_data: Dict[str, Any], endpoint: str) -> Dict[str, Any]:
+    """Build error payload for 404 responses."""
+    result = _ERR_404.copy()
+    result["detail"] = f"Endpoint not found: {endpoint}"
+    result["message"] = f"Backend endpoint {endpoint} not found"
+    return result
+
+
+def _build_5xx(response_data: Dict[str, Any], status: int) -> Dict[str, Any]:
+    """Build error payload for 5xx responses."""
+    error_msg = response_data.get("detail") or response_data.get("error") or "Server error"
+    result = _ERR_5XX.copy()
+    result["detail"] = error_msg
+    result["status"] = status
+    result["message"] = f"Backend server error: {error_msg}"
+    return result
+
+
+def _build_generic(response_data: Dict[str, Any], status: int) -> Dict[str, Any]:
+    """Build error payload for any other non-200 response."""
+    error_msg = response_data.get("detail") or response_data.get("error") or "Unknown error"
+    return {
+        "error": f"Backend error ({status})",
+        "detail": error_msg,
+        "status": status,
+        "message": f"Backend returned error: {error_msg}"
+    }
+
+
+# Statuses worth retrying for idempotent reads; anything else is returned to the caller immediately
+_RETRYABLE_STATUSES = frozenset({408, 425, 429, 500, 502, 503, 504})
+
+# Webhooks bill usage, so only retry statuses where the backend did not process the request;
+# a 5xx from a proxy may arrive after Django already committed the usage
+_WEBHOOK_RETRYABLE_STATUSES = frozenset({429, 503})
+
+# Network failures where the request never reached the server, so even billing POSTs can be resent
+_UNSENT_ERRORS = (aiohttp.ClientConnectorError, aiohttp.ConnectionTimeoutError)
+
+# Error payload builders for specific statuses; 5xx and others are handled by range
+_ERR_BUILDERS = {401: _build_401, 403: _build_403, 404: _build_404}
+
+
+def _decode_body(raw: bytes) -> Dict[str, Any]:
+    """Parse a JSON response body, falling back to its text for non-JSON replies."""
+    if not raw:
+        return {}
+    # Skip the parser for bodies that can't be a JSON object, e.g. proxy HTML error pages
+    if raw[:1] in (b"{", b"["):
+        try:
+            return orjson.loads(raw)
+        except orjson.JSONDecodeError:
+            pass
+    return {"detail": raw.decode("utf-8", "replace")}
+
+
+def _classify_error(status: int, raw: bytes, endpoint: str) -> Dict[str, Any]:
+    """Build the error payload for a non-200 backend response."""
+    response_data = _decode_body(raw)
+    builder = _ERR_BUILDERS.get(status)
+    if builder is not None:
+        return builder(response_data, endpoint)
+    if status >= 500:
+        return _build_5xx(response_data, status)
+    return _build_generic(response_data, status)
+
+
+async def read_response_bytes(
+    response: aiohttp.ClientResponse,
+    chunk_size: int = 64 * 1024,
+    max_size: Optional[int] = None
+) -> bytearray:
+    """Read a response body in chunks into a buffer preallocated from Content-Length.
+    
+    Bodies larger than ``max_size`` (default ``MAX_IMAGE_BYTES``) are rejected, and the
+    preallocation is clamped to it since Content-Length is controlled by the remote server.
+    The buffer is returned as-is to avoid copying the body again.
+    """
+    if max_size is None:
+        max_size = MAX_IMAGE_BYTES
+    declared = response.content_length
+    if declared is not None and declared > max_size:
+        raise Exception(f"Response body of {declared} bytes exceeds the {max_size} byte limit")
+    buf = bytearray(declared or 0)
+    offset = 0
+    async for chunk in response.content.iter_chunked(chunk_size):
+        size = len(chunk)
+        if offset + size > max_size:
+            raise Exception(f"Response body exceeds the {max_size} byte limit")
+        # Slice assignment grows the buffer if the body exceeds Content-Length
+        buf[offset:offset + size] = chunk
+        offset += size
+    del buf[offset:]
+    return buf
 
 
 class HTTPClient:
@@ -11,112 +144,168 @@ class HTTPClient:
     
     def __init__(self):
         self.base_url = os.getenv("BACKEND_URL", "http://localhost:8000")
-        self.timeout = ClientTimeout(total=30)
+        # Bound to the shared session; connect/sock_read fail fast when the backend is down
+        self.timeout = ClientTimeout(total=30, connect=5, sock_read=25)
+        self.webhook_timeout = ClientTimeout(total=60, connect=5)
         self.max_retries = 3
         self.retry_delay = 1
+        self._backoff = [self.retry_delay * (2 ** attempt) for attempt in range(self.max_retries)]
+        self.session: Optional[aiohttp.ClientSession] = None
+        self._session_lock = asyncio.Lock()
+        # Shared across requests; treat as read-only
+        self._default_headers = {"Content-Type": "application/json"}
+        self._url_auth = f"{self.base_url}{AUTH_VERIFY_ENDPOINT}"
+        self._url_credits = f"{self.base_url}{CREDITS_CHECK_ENDPOINT}"
+        self._url_webhook = f"{self.base_url}{WEBHOOK_ENDPOINT}"
+        self._url_webhook_bulk = f"{self.base_url}{WEBHOOK_BULK_ENDPOINT}"
+        # Opt-in: the backend must expose the bulk webhook endpoint
+        self.webhook_batching = os.getenv("WEBHOOK_BATCHING", "false").lower() == "true"
+        self._webhook_batcher = WebhookBatcher(
+            self._send_webhook_batch,
+            max_batch=int(os.getenv("WEBHOOK_BATCH_SIZE", "50")),
+            max_delay=float(os.getenv("WEBHOOK_BATCH_DELAY", "5.0"))
+        )
+        # Backend lookups currently running, shared by concurrent callers with the same key
+        self._inflight: Dict[Tuple[str, ...], asyncio.Future] = {}
+    
+    async def get_session(self) -> aiohttp.ClientSession:
+        """Return the shared pooled session, creating it on first use."""
+        session = self.session
+        if session is not None and not session.closed:
+            return session
+        async with self._session_lock:
+            if self.session is None or self.session.closed:
+                self.session = aiohttp.ClientSession(
+                    timeout=self.timeout,
+                    connector=aiohttp.TCPConnector(
+                        limit=256,
+                        limit_per_host=64,
+                        keepalive_timeout=60,
+                        ttl_dns_cache=300,
+                        use_dns_cache=True
+                    )
+                )
+            return self.session
+    
+    async def start(self):
+        """Create the shared session ahead of the first request."""
+        await self.get_session()
     
-    async def _request(
+    async def close(self):
+        """Flush batched webhooks, then close the shared session and release pooled connections."""
+        await self._webhook_batcher.close()
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+    
+    async def __aenter__(self) -> "HTTPClient":
+        await self.start()
+        return self
+    
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+    
+    def _retry_delay_for(self, attempt: int) -> float:
+        """Exponential backoff for attempt, with jitter so clients don't retry in lockstep."""
+        return self._backoff[attempt] + random.random() * 0.1
+    
+    async def _core_send(
         self,
+        session: aiohttp.ClientSession,
         method: str,
-        endpoint: str,
-        data: Optional[Dict[str, Any]] = None,
-        headers: Optional[Dict[str, str]] = None,
-    ) -> Dict[str, Any]:
-        """Make HTTP request with retry logic and detailed error handling."""
-        url = f"{self.base_url}{endpoint}"
-        default_headers = {"Content-Type": "application/json"}
-        if headers:
-            default_headers.update(headers)
+        url: str,
+        body: Optional[bytes],
+        headers: Dict[str, str],
+        timeout: ClientTimeout,
+        retry_statuses: frozenset,
+        params: Optional[Dict[str, str]] = None,
+        idempotent: bool = True,
+    ) -> Tuple[int, bytes]:
+        """Send a request, retrying network failures and statuses in retry_statuses; return status and raw body.
         
+        Non-idempotent requests only retry failures where the request never reached the
+        server; read timeouts and disconnects raise, since the backend may have processed them.
+        """
         last_error = None
         for attempt in range(self.max_retries):
             try:
-                async with aiohttp.ClientSession(timeout=self.timeout) as session:
-                    async with session.request(
-                        method, url, json=data, headers=default_headers
-                    ) as response:
-                        response_data = None
-                        try:
-                            response_data = await response.json()
-                        except:
-                            response_text = await response.text()
-                            response_data = {"detail": response_text} if response_text else {}
-                        
-                        if response.status == 200:
-                            return response_data
-                        elif response.status == 401:
-                            error_msg = response_data.get("detail", response_data.get("error", "Authentication failed"))
-                            return {
-                                "error": "Unauthorized",
-                                "detail": error_msg,
-                                "status": 401,
-                                "message": f"Authentication failed: {error_msg}"
-                            }
-                        elif response.status == 403:
-                            error_msg = response_data.get("detail", response_data.get("error", "Access forbidden"))
-                            return {
-                                "error": "Forbidden",
-                                "detail": error_msg,
-                                "status": 403,
-                                "message": f"Insufficient credits or access denied: {error_msg}"
-                            }
-                        elif response.status == 404:
-                            return {
-                                "error": "Not Found",
-                                "detail": f"Endpoint not found: {endpoint}",
-                                "status": 404,
-                                "message": f"Backend endpoint {endpoint} not found"
-                            }
-                        elif response.status >= 500:
-                            error_msg = response_data.get("detail", response_data.get("error", "Server error"))
-                            return {
-                                "error": "Backend Server Error",
-                                "detail": error_msg,
-                                "status": response.status,
-                                "message": f"Backend server error: {error_msg}"
-                            }
-                        else:
-                            error_msg = response_data.get("detail", response_data.get("error", "Unknown error"))
-                            return {
-                                "error": f"Backend error ({response.status})",
-                                "detail": error_msg,
-                                "status": response.status,
-                                "message": f"Backend returned error: {error_msg}"
-                            }
+                async with session.request(
+                    method, url, params=params, data=body, headers=headers, timeout=timeout
+                ) as response:
+                    status = response.status
+                    raw = await response.read()
+                if status not in retry_statuses or attempt == self.max_retries - 1:
+                    return status, raw
+                
+                # Transient backend status: back off and retry on the same session
+                last_error = f"Backend returned {status}"
+                await asyncio.sleep(self._retry_delay_for(attempt))
             except ClientError as e:
                 last_error = f"Network error: {str(e)}"
-                if attempt == self.max_retries - 1:
-                    raise Exception(f"Network error after {self.max_retries} attempts connecting to {url}: {str(e)}")
-                await asyncio.sleep(self.retry_delay * (2 ** attempt))
+                if attempt == self.max_retries - 1 or not (idempotent or isinstance(e, _UNSENT_ERRORS)):
+                    raise Exception(f"Network error after {attempt + 1} attempts connecting to {url}: {str(e)}")
+                await asyncio.sleep(self._retry_delay_for(attempt))
             except asyncio.TimeoutError:
                 last_error = "Request timeout"
-                if attempt == self.max_retries - 1:
-                    raise Exception(f"Request timeout after {self.max_retries} attempts for {url}")
-                await asyncio.sleep(self.retry_delay * (2 ** attempt))
+                if attempt == self.max_retries - 1 or not idempotent:
+                    raise Exception(f"Request timeout after {attempt + 1} attempts for {url}")
+                await asyncio.sleep(self._retry_delay_for(attempt))
             except Exception as e:
                 last_error = str(e)
-                if attempt == self.max_retries - 1:
-                    raise Exception(f"Request failed after {self.max_retries} attempts for {url}: {str(e)}")
-                await asyncio.sleep(self.retry_delay * (2 ** attempt))
+                if attempt == self.max_retries - 1 or not idempotent:
+                    raise Exception(f"Request failed after {attempt + 1} attempts for {url}: {str(e)}")
+                await asyncio.sleep(self._retry_delay_for(attempt))
         
         raise Exception(f"Request failed after all retries: {last_error}")
     
+    async def _single_flight(
+        self, key: Tuple[str, ...], fetch: Callable[[], Awaitable[Dict[str, Any]]]
+    ) -> Dict[str, Any]:
+        """Run fetch once per key at a time; concurrent callers await the same in-flight call."""
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fetch())
+            self._inflight[key] = task
+            task.add_done_callback(lambda done: self._finish_flight(key, done))
+        # Shield so one caller being cancelled doesn't cancel the call for everyone else
+        return await asyncio.shield(task)
+    
+    def _finish_flight(self, key: Tuple[str, ...], done: asyncio.Future):
+        """Forget a finished call, marking its exception retrieved in case every caller was cancelled."""
+        self._inflight.pop(key, None)
+        if not done.cancelled():
+            done.exception()
+    
     async def verify_auth(self, user_id: str, api_key: str) -> Dict[str, Any]:
         """Verify user authentication with backend."""
-        return await self._request(
-            "POST",
-            "/api/v1/auth/verify/",
-            data={"user_id": user_id, "api_key": api_key}
+        return await self._single_flight(
+            ("auth", user_id, api_key), lambda: self._fetch_auth(user_id, api_key)
         )
     
+    async def _fetch_auth(self, user_id: str, api_key: str) -> Dict[str, Any]:
+        """Call the auth endpoint."""
+        body = orjson.dumps({"user_id": user_id, "api_key": api_key})
+        status, raw = await self._core_send(
+            await self.get_session(), "POST", self._url_auth, body, self._default_headers, self.timeout,
+            _RETRYABLE_STATUSES
+        )
+        if status == 200:
+            return _decode_body(raw)
+        return _classify_error(status, raw, AUTH_VERIFY_ENDPOINT)
+    
     async def check_credits(self, user_id: str) -> Dict[str, Any]:
         """Check available credits for user."""
-        from urllib.parse import urlencode
-        params = urlencode({"user_id": user_id})
-        return await self._request(
-            "GET",
-            f"/api/v1/credits/check/?{params}"
+        return await self._single_flight(("credits", user_id), lambda: self._fetch_credits(user_id))
+    
+    async def _fetch_credits(self, user_id: str) -> Dict[str, Any]:
+        """Call the credits endpoint."""
+        status, raw = await self._core_send(
+            await self.get_session(), "GET", self._url_credits, None, self._default_headers, self.timeout,
+            _RETRYABLE_STATUSES, params={"user_id": user_id}
         )
+        if status == 200:
+            return _decode_body(raw)
+        return _classify_error(status, raw, CREDITS_CHECK_ENDPOINT)
     
     async def send_webhook(
         self,
@@ -126,19 +315,31 @@ class HTTPClient:
         image_url: str,
         latency_ms: float
     ) -> Dict[str, Any]:
-        """Send webhook update to backend."""
-        return await self._request(
-            "POST",
-            "/api/v1/inference/webhook/",
-            data={
-                "user_id": user_id,
-                "used_credits": used_credits,
-                "catalog_id": catalog_id,
-                "image_url": image_url,
-                "latency_ms": latency_ms
-            }
+        """Send webhook update to backend, or queue it for the next bulk send when batching is enabled."""
+        event = {
+            "user_id": user_id,
+            "used_credits": used_credits,
+            "catalog_id": catalog_id,
+            "image_url": image_url,
+            "latency_ms": latency_ms
+        }
+        if self.webhook_batching:
+            await self._webhook_batcher.add(event)
+            return {"queued": True}
+        status, raw = await self._core_send(
+            await self.get_session(), "POST", self._url_webhook, orjson.dumps(event),
+            self._default_headers, self.webhook_timeout, _WEBHOOK_RETRYABLE_STATUSES, idempotent=False
         )
-
-
-http_client = HTTPClient()
-
+        if status == 200:
+            return _decode_body(raw)
+        return _classify_error(status, raw, WEBHOOK_ENDPOINT)
+    
+    async def _send_webhook_batch(self, events: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Send a batch of webhook events in a single bulk request."""
+        status, raw = await self._core_send(
+            await self.get_session(), "POST", self._url_webhook_bulk, orjson.dumps({"events": events}),
+            self._default_headers, self.webhook_timeout, _WEBHOOK_RETRYABLE_STATUSES, idempotent=False
+        )
+        if status == 200:
+            return _decode_body(raw)
+        return _classify_error(status, raw, WEBHOOK_BULK_ENDPOINT)
@@ -1,61 +1,161 @@
 """Rate limiting and throttling middleware."""
 import time
-from collections import defaultdict
+import heapq
+import asyncio
+from collections import OrderedDict, deque
 from fastapi import Request, HTTPException, status
 from starlette.middleware.base import BaseHTTPMiddleware
-from typing import Dict, Tuple
+from typing import Deque, Dict, List, Tuple
 
 
 class ThrottleMiddleware(BaseHTTPMiddleware):
-    """Throttle requests per user/IP."""
+    """Throttle requests per user/IP.
     
-    def __init__(self, app, requests_per_minute: int = 10):
+    Strategies:
+    - ``token_bucket`` (default): O(1) per request, allows bursts up to the limit.
+    - ``sliding_window``: exact count of requests in the trailing minute.
+    """
+    
+    def __init__(
+        self,
+        app,
+        requests_per_minute: int = 10,
+        strategy: str = "token_bucket",
+        max_users: int = 100_000
+    ):
         super().__init__(app)
+        if strategy not in ("token_bucket", "sliding_window"):
+            raise ValueError(f"Unknown throttle strategy: {strategy}")
         self.requests_per_minute = requests_per_minute
-        self.requests: Dict[str, list] = defaultdict(list)
+        # Cap on tracked clients; least recently seen are evicted so junk ids can't grow memory unbounded
+        self.max_users = max_users
+        self.strategy = strategy
+        self.capacity = float(requests_per_minute)
+        self.refill_rate = requests_per_minute / 60.0
+        # token_bucket: user_id -> [tokens, last_refill]; mutated in place to avoid per-request allocations
+        self.buckets: "OrderedDict[str, List[float]]" = OrderedDict()
+        # token_bucket: tokens consumed this tick, applied to buckets by _flush_pending
+        self._pending: Dict[str, int] = {}
+        self._flush_scheduled = False
+        # sliding_window: user_id -> ring of the last requests_per_minute timestamps, oldest first
+        self.requests: "OrderedDict[str, Deque[float]]" = OrderedDict()
+        self._allow = self._take_token if strategy == "token_bucket" else self._record_request
+        # Latest expiry per tracked user, plus a min-heap of (expiry, user_id) with about one
+        # entry per user; cleanup only touches expired entries instead of every user
+        self._expiry: Dict[str, float] = {}
+        self._expiry_heap: List[Tuple[float, str]] = []
         self.cleanup_interval = 60
-        self.last_cleanup = time.time()
+        self.last_cleanup = time.monotonic()
     
     async def dispatch(self, request: Request, call_next):
-        # Cleanup old entries periodically
-        current_time = time.time()
+        # Cleanup old entries periodically (monotonic: immune to wall-clock jumps)
+        current_time = time.monotonic()
         if current_time - self.last_cleanup > self.cleanup_interval:
             self._cleanup_old_entries(current_time)
             self.last_cleanup = current_time
         
-        # Get client identifier
-        client_id = request.client.host if request.client else "unknown"
-        user_id = request.headers.get("X-User-ID") or client_id
+        # Get client identifier; only resolve the client address when no user header is sent
+        user_id = request.headers.get("X-User-ID")
+        if not user_id:
+            client = request.client
+            user_id = client.host if client is not None else "unknown"
         
-        # Check rate limit
-        if self._is_rate_limited(user_id, current_time):
+        # Check rate limit and record request
+        if not self._allow(user_id, current_time):
             raise HTTPException(
                 status_code=status.HTTP_429_TOO_MANY_REQUESTS,
                 detail=f"Rate limit exceeded. Maximum {self.requests_per_minute} requests per minute."
             )
         
-        # Record request
-        self.requests[user_id].append(current_time)
-        
         # Process request
         response = await call_next(request)
         return response
     
-    def _is_rate_limited(self, user_id: str, current_time: float) -> bool:
-        """Check if user has exceeded rate limit."""
-        minute_ago = current_time - 60
-        user_requests = [req_time for req_time in self.requests[user_id] if req_time > minute_ago]
-        self.requests[user_id] = user_requests
-        return len(user_requests) >= self.requests_per_minute
+    def _take_token(self, user_id: str, current_time: float) -> bool:
+        """Decide whether user's bucket has a token, counting consumptions not yet flushed.
+        
+        The decision is made per request, but the bucket write is deferred to
+        _flush_pending so a burst within one event-loop tick updates each bucket once.
+        """
+        bucket = self.buckets.get(user_id)
+        if bucket is None:
+            tokens = self.capacity
+        else:
+            tokens = min(self.capacity, bucket[0] + (current_time - bucket[1]) * self.refill_rate)
+        pending = self._pending.get(user_id, 0)
+        if tokens - pending < 1:
+            return False
+        
+        self._pending[user_id] = pending + 1
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            asyncio.get_running_loop().call_soon(self._flush_pending)
+        return True
+    
+    def _flush_pending(self):
+        """Apply token consumptions coalesced during the last event-loop tick."""
+        self._flush_scheduled = False
+        pending, self._pending = self._pending, {}
+        current_time = time.monotonic()
+        for user_id, count in pending.items():
+            bucket = self.buckets.get(user_id)
+            if bucket is None:
+                if len(self.buckets) >= self.max_users:
+                    evicted, _ = self.buckets.popitem(last=False)
+                    self._expiry.pop(evicted, None)
+                bucket = self.buckets[user_id] = [self.capacity, current_time]
+            else:
+                self.buckets.move_to_end(user_id)
+                bucket[0] = min(self.capacity, bucket[0] + (current_time - bucket[1]) * self.refill_rate)
+                bucket[1] = current_time
+            bucket[0] -= count
+            self._track(user_id, current_time)
+    
+    def _record_request(self, user_id: str, current_time: float) -> bool:
+        """Record the request in user's ring of recent timestamps. Returns False if the window is full."""
+        timestamps = self.requests.get(user_id)
+        if timestamps is None:
+            if len(self.requests) >= self.max_users:
+                evicted, _ = self.requests.popitem(last=False)
+                self._expiry.pop(evicted, None)
+            # Fixed-size ring: appending to a full deque drops the oldest timestamp
+            timestamps = self.requests[user_id] = deque(maxlen=self.requests_per_minute)
+        else:
+            self.requests.move_to_end(user_id)
+        
+        # Only the oldest of the last N requests matters: if it is still inside the
+        # window, N requests were made in the last minute
+        if len(timestamps) >= self.requests_per_minute and (not timestamps or timestamps[0] > current_time - 60):
+            return False
+        timestamps.append(current_time)
+        self._track(user_id, current_time)
+        return True
+    
+    def _track(self, user_id: str, current_time: float):
+        """Schedule user's state for expiry a minute after this request."""
+        if user_id not in self._expiry:
+            heapq.heappush(self._expiry_heap, (current_time + 60, user_id))
+            # Entries of evicted users linger until popped; rebuild so the heap stays bounded
+            if len(self._expiry_heap) > 2 * self.max_users:
+                self._expiry_heap = [(expiry, uid) for uid, expiry in self._expiry.items()]
+                self._expiry_heap.append((current_time + 60, user_id))
+                heapq.heapify(self._expiry_heap)
+        self._expiry[user_id] = current_time + 60
     
     def _cleanup_old_entries(self, current_time: float):
-        """Remove entries older than 1 minute."""
-        minute_ago = current_time - 60
-        for user_id in list(self.requests.keys()):
-            self.requests[user_id] = [
-                req_time for req_time in self.requests[user_id] 
-                if req_time > minute_ago
-            ]
-            if not self.requests[user_id]:
-                del self.requests[user_id]
-
+        """Remove state for users with no tracked request in the last minute."""
+        heap = self._expiry_heap
+        while heap and heap[0][0] <= current_time:
+            _, user_id = heapq.heappop(heap)
+            expiry = self._expiry.get(user_id)
+            if expiry is None:
+                # Already evicted by the max_users cap
+                continue
+            if expiry > current_time:
+                # Seen again since this entry was pushed; reschedule at its latest expiry
+                heapq.heappush(heap, (expiry, user_id))
+                continue
+            # Idle for a full minute: the bucket has refilled / the window is empty
+            del self._expiry[user_id]
+            self.buckets.pop(user_id, None)
+            self.requests.pop(user_id, None)
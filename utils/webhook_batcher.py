@@ -0,0 +1,78 @@
+"""Coalesces webhook events into bulk backend requests."""
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+from services.logger import logger
+
+
+class WebhookBatcher:
+    """Queue webhook events and send them in batches of up to max_batch events or every max_delay seconds."""
+
+    def __init__(
+        self,
+        send_batch: Callable[[List[Dict[str, Any]]], Awaitable[Dict[str, Any]]],
+        max_batch: int = 50,
+        max_delay: float = 5.0
+    ):
+        self.send_batch = send_batch
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        """Start the background sender on the running event loop."""
+        if self._task is None or self._task.done():
+            self._queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._run())
+
+    async def add(self, event: Dict[str, Any]):
+        """Queue an event for the next batch."""
+        if self._task is None or self._task.done():
+            self.start()
+        self._queue.put_nowait(event)
+
+    async def close(self):
+        """Flush queued events and stop the background sender."""
+        if self._task is None or self._task.done():
+            return
+        # None tells the sender to flush what it has and exit
+        self._queue.put_nowait(None)
+        await self._task
+        self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            event = await self._queue.get()
+            if event is None:
+                break
+            events = [event]
+            deadline = loop.time() + self.max_delay
+            while len(events) < self.max_batch:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    event = await asyncio.wait_for(self._queue.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+                if event is None:
+                    stopping = True
+                    break
+                events.append(event)
+            await self._send(events)
+
+    async def _send(self, events: List[Dict[str, Any]]):
+        """Send one batch, logging failures since no caller is waiting on it."""
+        try:
+            result = await self.send_batch(events)
+        except Exception as e:
+            logger.log_event("webhook_batch_failed", logging.ERROR, events=len(events), error=str(e))
+            return
+        if result.get("error"):
+            logger.log_event(
+                "webhook_batch_rejected", logging.ERROR,
+                events=len(events), error=result.get("message") or result.get("error")
+            )